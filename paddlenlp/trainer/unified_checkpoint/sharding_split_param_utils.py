@@ -15,14 +15,17 @@
 
 import gc
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import paddle
 import paddle.distributed as dist
 from paddle.distributed import fleet
 from tqdm.auto import tqdm
 
 from paddlenlp.peft import LoRAModel, PrefixModelForCausalLM
-from paddlenlp.transformers.model_utils import load_state_dict
+from paddlenlp.transformers.model_utils import _load_part_state_dict
+from paddlenlp.transformers.utils import device_guard
 from paddlenlp.utils.env import (
     SAFE_MASTER_WEIGHTS_INDEX_NAME,
     SAFE_OPTIMIZER_INDEX_NAME,
@@ -35,83 +38,290 @@ from .utils import (
     get_expected_state_dict,
     get_optimizer_shard_files,
     mapping_optimizer_tp_actions,
+    rename_and_store,
 )
 
 __all__ = ["gather_splited_param_for_optimizer", "load_unified_optimizer_split_param"]
 
 
-def merge_splited_param(
-    state_dict, partial_tensor_list, param_shape_info, send_table, recv_table, is_master_weights=False
-):
-    """Merge the splited param in sharding group."""
-    global_rank = dist.get_rank()
-    for key in list(state_dict.keys()):
-        if state_dict[key].numel().item() == 1:  # for example: beta1, beta2
-            continue
-
-        static_name = key if is_master_weights else generate_base_static_name(key)[0]
-        shape, numel, index, padded_size = param_shape_info[static_name]
-        if static_name not in partial_tensor_list:
-            state_dict[key] = state_dict[key].reshape(shape)
+def _is_scalar(tensor):
+    """Check whether the tensor has only one element from its shape, without launching a device op."""
+    return int(np.prod(tensor.shape)) == 1
+
+
+def _pop_scalar_states(state_dict):
+    """Pop the scalar states (for example: beta1, beta2) out of state_dict, so that only real tensors are merged."""
+    scalar_states = {key: tensor for key, tensor in state_dict.items() if _is_scalar(tensor)}
+    for key in scalar_states.keys():
+        state_dict.pop(key)
+    return scalar_states
+
+
+def plan_merge_splited_param(key_infos, partial_tensor_list, param_shape_info, send_table, recv_table, global_rank):
+    """
+    Plan the merge of the splited params on `global_rank` without any tensor op. Every rank walks the states
+    in the same order, so the pieces in a send buffer match the pieces in the peer's recv buffer one by one.
+
+    Args:
+        key_infos (list): (key, static_name, dtype) of the local states, in the same order on every rank.
+
+    Returns:
+        full_tensor_list (list): (key, shape) of the states holding the full param, which only need reshape.
+        send_buckets (dict): (recv_rank, dtype) -> [(key, length)], the first `length` elements of each state
+            are packed into one send buffer.
+        recv_buckets (dict): (send_rank, dtype) -> [(key, slot, length)], one recv buffer, whose pieces go to
+            `slot` of the merged states.
+        merge_list (dict): key -> (shape, num_slots, local_slot, local_length) of the states merged on this rank.
+    """
+    # Lay out the param meta info as arrays indexed by a compact key id, and do the padding
+    # arithmetic for all params at once instead of per key inside the loop.
+    key2id = {name: i for i, name in enumerate(param_shape_info.keys())}
+    shapes = [info[0] for info in param_shape_info.values()]
+    numels = np.array([info[1] for info in param_shape_info.values()], dtype=np.int64)
+    indices = np.array([info[2] for info in param_shape_info.values()], dtype=np.int64)
+    padded_sizes = np.array([info[3] for info in param_shape_info.values()], dtype=np.int64)
+    base_padding_starts = (indices + numels).tolist()
+    base_padding_ends = (indices + padded_sizes).tolist()
+    recv_ranks = np.full([len(key2id)], -1, dtype=np.int64)  # -1 means not a partial tensor
+    for name in partial_tensor_list:
+        recv_ranks[key2id[name]] = recv_table[name]
+    recv_ranks = recv_ranks.tolist()
+
+    full_tensor_list = []
+    send_buckets = {}
+    recv_buckets = {}
+    merge_list = {}
+    for key, static_name, dtype in key_infos:
+        key_id = key2id[static_name]
+        recv_rank = recv_ranks[key_id]
+        if recv_rank < 0:
+            full_tensor_list.append((key, shapes[key_id]))
             continue
 
-        recv_rank = recv_table[static_name]
         send_info = send_table[static_name]
-
-        base_padding_start = index + numel
-        base_padding_end = index + padded_size
+        base_padding_start = base_padding_starts[key_id]
+        base_padding_end = base_padding_ends[key_id]
 
         if global_rank == recv_rank:
-            tmp_tensor_list = []
-            for send_rank, begin, end in send_info:
+            local_slot, local_length = None, None
+            for slot, (send_rank, begin, end) in enumerate(send_info):
                 padding_start = max(begin, base_padding_start)
                 padding_end = min(end, base_padding_end)
-
+                # drop the padding at the tail of the slice
+                length = end - begin if padding_start >= padding_end else padding_start - begin
                 if send_rank == recv_rank:
-                    tensor = (
-                        state_dict[key] if padding_start >= padding_end else state_dict[key][: padding_start - begin]
-                    )
-                    tmp_tensor_list.append(tensor)
+                    local_slot, local_length = slot, length
                 else:
-                    length = end - begin if padding_start >= padding_end else padding_start - begin
-                    tmp_tensor = paddle.empty(shape=[length], dtype=state_dict[key].dtype)
-                    dist.stream.recv(tmp_tensor, src=send_rank)
-                    tmp_tensor_list.append(tmp_tensor)
-            state_dict[key] = paddle.concat(tmp_tensor_list, axis=0).reshape(shape)
+                    recv_buckets.setdefault((send_rank, dtype), []).append((key, slot, length))
+            merge_list[key] = (shapes[key_id], len(send_info), local_slot, local_length)
         else:
             for send_rank, begin, end in send_info:
-                padding_start = max(begin, base_padding_start)
-                padding_end = min(end, base_padding_end)
                 if global_rank == send_rank:
-                    tensor = (
-                        state_dict[key] if padding_start >= padding_end else state_dict[key][: padding_start - begin]
-                    )
-                    dist.stream.send(tensor, dst=recv_rank)
-                    state_dict.pop(key)
+                    padding_start = max(begin, base_padding_start)
+                    padding_end = min(end, base_padding_end)
+                    length = end - begin if padding_start >= padding_end else padding_start - begin
+                    send_buckets.setdefault((recv_rank, dtype), []).append((key, length))
+    return full_tensor_list, send_buckets, recv_buckets, merge_list
+
+
+def merge_splited_param(
+    state_dict,
+    partial_tensor_list,
+    param_shape_info,
+    send_table,
+    recv_table,
+    is_master_weights=False,
+    static_name_mappings=None,
+):
+    """Merge the splited param in sharding group.
+
+    Slices travelling between the same pair of ranks are packed by dtype into one flat buffer, so that small
+    tensors (bias, layernorm, etc.) do not each cost a separate send/recv. All send buffers are packed before the
+    comm is launched, so the extra memory is the total size of the slices sent by this rank.
+    `static_name_mappings` maps optimizer keys to their base static names, it is computed here if not given.
+    Scalar states should be popped out of `state_dict` by the caller, see `_pop_scalar_states`.
+    """
+    global_rank = dist.get_rank()
+    if not is_master_weights and static_name_mappings is None:
+        static_name_mappings = {key: generate_base_static_name(key)[0] for key in state_dict.keys()}
+
+    key_infos = [
+        (key, key if is_master_weights else static_name_mappings[key], tensor.dtype)
+        for key, tensor in state_dict.items()
+    ]
+    full_tensor_list, send_buckets, recv_buckets, merge_list = plan_merge_splited_param(
+        key_infos, partial_tensor_list, param_shape_info, send_table, recv_table, global_rank
+    )
+
+    p2p_ops = []
+    for (recv_rank, _), pieces in send_buckets.items():
+        fused_tensor = paddle.concat([state_dict[key][:length] for key, length in pieces], axis=0)
+        p2p_ops.append(dist.P2POp(dist.isend, fused_tensor, recv_rank))
+    recv_bucket_list = []
+    for (send_rank, dtype), pieces in recv_buckets.items():
+        fused_tensor = paddle.empty(shape=[sum(length for _, _, length in pieces)], dtype=dtype)
+        p2p_ops.append(dist.P2POp(dist.irecv, fused_tensor, send_rank))
+        recv_bucket_list.append((fused_tensor, pieces))
+
+    # All buffers are prepared above, launch the comm asynchronously and do the
+    # remaining host-side work while it is in flight.
+    tasks = dist.batch_isend_irecv(p2p_ops) if len(p2p_ops) > 0 else []
+
+    for key, shape in full_tensor_list:
+        state_dict[key] = state_dict[key].reshape(shape)
+
+    merged_tensor_lists = {}
+    for key, (_, num_slots, local_slot, local_length) in merge_list.items():
+        merged_tensor_lists[key] = [None] * num_slots
+        merged_tensor_lists[key][local_slot] = state_dict[key][:local_length]
+
+    for task in tasks:
+        task.wait()
+
+    for fused_tensor, pieces in recv_bucket_list:
+        offset = 0
+        for key, slot, length in pieces:
+            merged_tensor_lists[key][slot] = fused_tensor[offset : offset + length]
+            offset += length
+
+    # The merged tensor is kept by the recv rank only, the send ranks drop their slices from the result.
+    for pieces in send_buckets.values():
+        for key, _ in pieces:
+            state_dict.pop(key)
+    for key, (shape, _, _, _) in merge_list.items():
+        state_dict[key] = paddle.concat(merged_tensor_lists[key], axis=0).reshape(shape)
+    return state_dict
+
+
+def get_params_info(comm_buffer_list):
+    """Get the slice (begin, end) and shape (shape, numel, index, padded_size, has_pad) info of the sharding params."""
+    param_slice_info = {}
+    param_shape_info = {}
+    for buffer in comm_buffer_list:
+        for key, param_view in buffer._sharding_param_grad_view.items():
+            shape = tuple(param_view._param.shape)
+            # compute numel on host, avoid a device sync per param
+            numel = int(np.prod(shape))
+            param_slice_info[key] = (param_view._param_begin, param_view._param_end)
+            padded_size = param_view._padded_size
+            param_shape_info[key] = (shape, numel, param_view._index, padded_size, padded_size > numel)
+    return param_slice_info, param_shape_info
+
+
+def reshape_params(
+    state_dict, struct2static_name_mappings, param_shape_info, param_slice_info, is_master_weights=False
+):
+    """
+    Slice the loaded params to the local sharding range, and pad with zeros if needed.
+    Return {key: (struct_name, typename, static_name)} of all keys, typename is None for master weights.
+    """
+    # Resolve names and index math once, so that the loop below only does the slicing.
+    key_names = {}
+    plan = []
+    for key, tensor in state_dict.items():
+        if is_master_weights:
+            struct_name, typename = key, None
+        else:
+            struct_name, typename = key.split("/")
+        static_name = struct2static_name_mappings.get(struct_name, None)
+        key_names[key] = (struct_name, typename, static_name)
+        if _is_scalar(tensor):  # for example: beta1, beta2
+            continue
+        begin, end = param_slice_info[static_name]
+        _, numel, index, padded_size, has_pad = param_shape_info[static_name]
+        if not has_pad:
+            plan.append((key, begin - index, end - index, 0))
+            continue
+        padding_len = max(0, min(end, index + padded_size) - max(begin, index + numel))
+        plan.append((key, begin - index, end - index, padding_len))
+
+    for key, slice_begin, slice_end, padding_len in plan:
+        tensor = state_dict[key].reshape([-1])[slice_begin:slice_end]
+        if padding_len > 0:
+            # Fill the live part into a zero-initialized cpu buffer, instead of concat with a zero tensor.
+            # The live part is empty if the whole range of this rank is padding.
+            live_len = tensor.shape[0]
+            with device_guard():
+                padded_tensor = paddle.zeros([live_len + padding_len], dtype=tensor.dtype)
+                if live_len > 0:
+                    padded_tensor[:live_len] = tensor
+            tensor = padded_tensor
+        state_dict[key] = tensor
+    return key_names
+
+
+def fused_copy_to_device(state_dict, place, dtype=None):
+    """
+    Copy the cpu tensors in state_dict to `place`, with one fused transfer (and cast if `dtype` given) per dtype.
+
+    Memory cost: each dtype group is concatenated into one extra host buffer, which is released after the copy.
+    On device, the returned tensors are views of one fused buffer of the group size, so no extra device memory is
+    used, but the fused buffer is freed only after all of its views are released.
+    """
+    dtype_keys = {}
+    for key, tensor in state_dict.items():
+        dtype_keys.setdefault(tensor.dtype, []).append(key)
+
+    for src_dtype, keys in dtype_keys.items():
+        shapes = [state_dict[key].shape for key in keys]
+        sections = [int(np.prod(shape)) for shape in shapes]
+        with device_guard():
+            fused_tensor = paddle.concat([state_dict[key].reshape([-1]) for key in keys], axis=0)
+        # Blocking copy, since the host buffer is released once this function goes on to the next group.
+        fused_tensor = fused_tensor._copy_to(place, True)
+        if dtype is not None and src_dtype != dtype:
+            fused_tensor = paddle.cast(fused_tensor, dtype)
+        offset = 0
+        for key, shape, numel in zip(keys, shapes, sections):
+            state_dict[key] = fused_tensor[offset : offset + numel].reshape(shape)
+            offset += numel
     return state_dict
 
 
+def build_send_recv_table(partial_tensor_list, param_keys, gathered_slice_info):
+    """
+    Build the send/recv table of the partial tensors from the gathered slice info, an int64 array of shape
+    [sharding_degree, 1 + 2 * len(param_keys)], each row laid out as [global_rank, begin_0, end_0, begin_1, ...].
+    """
+    sharding_global_ranks = gathered_slice_info[:, 0]
+    # [sharding_degree, num_params, 2], the last dim is (begin, end)
+    sharding_param_slices = gathered_slice_info[:, 1:].reshape([len(sharding_global_ranks), len(param_keys), 2])
+
+    send_table = {}
+    recv_table = {}
+    param_key2id = {key: i for i, key in enumerate(param_keys)}
+    has_slice = sharding_param_slices[..., 1] > sharding_param_slices[..., 0]
+    for key in partial_tensor_list:
+        key_id = param_key2id[key]
+        ranks = np.nonzero(has_slice[:, key_id])[0]
+        send_table[key] = list(
+            zip(
+                sharding_global_ranks[ranks].tolist(),
+                sharding_param_slices[ranks, key_id, 0].tolist(),
+                sharding_param_slices[ranks, key_id, 1].tolist(),
+            )
+        )
+        recv_table[key] = send_table[key][0][0]  # which sharding_rank to recv the splited tensor
+    return send_table, recv_table
+
+
 def gather_splited_param_for_optimizer(optimizer):
     hcg = fleet.get_hybrid_communicate_group()
     sharding_group = hcg.get_sharding_parallel_group()
     global_rank = dist.get_rank()
-    param_slice_info = {}
-    param_shape_info = {}
-    for buffer in optimizer._inner_opt._comm_buffer_list:
-        for key in buffer._sharding_param_grad_view.keys():
-            param_slice_info[key] = (
-                buffer._sharding_param_grad_view[key]._param_begin,
-                buffer._sharding_param_grad_view[key]._param_end,
-            )
-            param_shape_info[key] = (
-                buffer._sharding_param_grad_view[key]._param.shape,
-                buffer._sharding_param_grad_view[key]._param.numel().item(),
-                buffer._sharding_param_grad_view[key]._index,
-                buffer._sharding_param_grad_view[key]._padded_size,
-            )
-    param_slice_info["global_rank"] = global_rank
-    param_slice_info_list = []
-    dist.all_gather_object(param_slice_info_list, param_slice_info, group=sharding_group)
+    param_slice_info, param_shape_info = get_params_info(optimizer._inner_opt._comm_buffer_list)
+    # All sharding ranks hold the same param keys, so the slice info can be exchanged as a
+    # fixed-size int64 tensor laid out as [global_rank, begin_0, end_0, begin_1, end_1, ...].
+    param_keys = sorted(param_slice_info.keys())
+    local_slice_info = [global_rank]
+    for key in param_keys:
+        local_slice_info.extend(param_slice_info[key])
+    if sharding_group.nranks > 1:
+        gathered_slice_info = []
+        dist.all_gather(gathered_slice_info, paddle.to_tensor(local_slice_info, dtype="int64"), group=sharding_group)
+        gathered_slice_info = np.stack([tensor.numpy() for tensor in gathered_slice_info])
+    else:
+        gathered_slice_info = np.array([local_slice_info], dtype=np.int64)
 
     optim_state_dict = nested_copy(optimizer.state_dict())
     master_weights = None
@@ -120,15 +330,16 @@ def gather_splited_param_for_optimizer(optimizer):
     if "LR_Scheduler" in optim_state_dict.keys():
         optim_state_dict.pop("LR_Scheduler")
 
+    scalar_states = _pop_scalar_states(optim_state_dict)
+
     # deal with optimizer param
+    static_name_mappings = {key: generate_base_static_name(key)[0] for key in optim_state_dict.keys()}
     partial_tensor_list = []
     for key in list(optim_state_dict.keys()):
-        static_name, _ = generate_base_static_name(key)
+        static_name = static_name_mappings[key]
         if static_name in param_slice_info.keys():
-            if optim_state_dict[key].numel().item() == 1:  # for example: beta1, beta2
-                continue
             begin, end = param_slice_info[static_name]
-            shape, numel, _, _ = param_shape_info[static_name]
+            shape, numel = param_shape_info[static_name][:2]
             if end - begin == numel:  # full tensor
                 optim_state_dict[key] = optim_state_dict[key].reshape(shape)
             elif end <= begin:  # empty tensor
@@ -136,25 +347,28 @@ def gather_splited_param_for_optimizer(optimizer):
             else:  # partial tensor, end > begin but end - begin < numel
                 partial_tensor_list.append(static_name)
 
-    send_table = {}
-    recv_table = {}
-    for key in partial_tensor_list:
-        sharding_ranklist = []
-        for slice_info in param_slice_info_list:
-            begin, end = slice_info[key]
-            if end > begin:
-                sharding_ranklist.append((slice_info["global_rank"], begin, end))
-        recv_table[key] = sharding_ranklist[0][0]  # which sharding_rank to recv the splited tensor
-        send_table[key] = [(rank, begin, end) for rank, begin, end in sharding_ranklist]
-
-    merge_splited_param(optim_state_dict, partial_tensor_list, param_shape_info, send_table, recv_table, False)
+    send_table, recv_table = build_send_recv_table(partial_tensor_list, param_keys, gathered_slice_info)
+    merge_splited_param(
+        optim_state_dict,
+        partial_tensor_list,
+        param_shape_info,
+        send_table,
+        recv_table,
+        False,
+        static_name_mappings=static_name_mappings,
+    )
+    optim_state_dict.update(scalar_states)
     if master_weights is not None:
+        scalar_master_weights = _pop_scalar_states(master_weights)
         merge_splited_param(master_weights, partial_tensor_list, param_shape_info, send_table, recv_table, True)
+        master_weights.update(scalar_master_weights)
     return optim_state_dict, master_weights
 
 
 def load_unified_optimizer_split_param(model, optimizer, resume_from_checkpoint):
     returned_optim_state_dict = nested_copy(optimizer.state_dict())
+    # read the target place before any background loading starts
+    place = paddle.framework._current_expected_place()
 
     index_filename, index_filename_master_weights = SAFE_OPTIMIZER_INDEX_NAME, SAFE_MASTER_WEIGHTS_INDEX_NAME
 
@@ -164,31 +378,15 @@ def load_unified_optimizer_split_param(model, optimizer, resume_from_checkpoint)
     )
     has_master_weights = True if sharded_metadata["master_weights"] else False
 
-    typename_set = set()
-    for key in sharded_metadata["weight_map"].keys():
-        _, typename = key.split("/")
-        typename_set.add(typename)
+    typename_set = {typename for _, typename in (key.split("/") for key in sharded_metadata["weight_map"].keys())}
 
     model_state_dict = get_expected_state_dict(model)
     model_keys = list(model_state_dict.keys())
     static2struct_name_mappings = {v.name: k for k, v in model_state_dict.items()}  # get optimizer param mappings
     struct2static_name_mappings = {k: v.name for k, v in model_state_dict.items()}
 
-    expected_keys = []
-    param_slice_info = {}
-    param_shape_info = {}
-    for buffer in optimizer._inner_opt._comm_buffer_list:
-        for key in buffer._sharding_param_grad_view.keys():
-            begin = buffer._sharding_param_grad_view[key]._param_begin
-            end = buffer._sharding_param_grad_view[key]._param_end
-            if end > begin:
-                expected_keys.append(key)
-                shape = buffer._sharding_param_grad_view[key]._param.shape
-                numel = buffer._sharding_param_grad_view[key]._param.numel().item()
-                index = buffer._sharding_param_grad_view[key]._index
-                padded_size = buffer._sharding_param_grad_view[key]._padded_size
-                param_slice_info[key] = (begin, end)
-                param_shape_info[key] = (shape, numel, index, padded_size)
+    param_slice_info, param_shape_info = get_params_info(optimizer._inner_opt._comm_buffer_list)
+    expected_keys = [key for key, (begin, end) in param_slice_info.items() if end > begin]
 
     expected_keys = set([static2struct_name_mappings.get(name, None) for name in expected_keys])
     expected_keys_optim = []
@@ -210,8 +408,8 @@ def load_unified_optimizer_split_param(model, optimizer, resume_from_checkpoint)
             resolved_archive_file_mw = tqdm(resolved_archive_file_mw, desc="Loading master weights shards")
 
     def load_resolved_archive_file(resolved_archive_file, sharded_metadata, expected_keys, is_master_weights=False):
-        returned_state_dict = {}
-
+        """Yield the state dict of each shard, while the next shard is being read in background."""
+        tp_actions = {}
         if model.config.tensor_parallel_degree > 1:
             if isinstance(model, LoRAModel) or isinstance(model, PrefixModelForCausalLM):
                 tp_actions = model._get_tensor_parallel_convert_actions(model_keys, is_split=True, ignore_error=True)
@@ -220,81 +418,69 @@ def load_unified_optimizer_split_param(model, optimizer, resume_from_checkpoint)
             if not is_master_weights:
                 tp_actions = mapping_optimizer_tp_actions(tp_actions, expected_keys)
 
-        for shard_file in resolved_archive_file:
-            if expected_keys.isdisjoint(sharded_metadata["file_map"][os.path.split(shard_file)[-1]]):
-                continue
-            if model.config.tensor_parallel_degree > 1:
-                state_dict = load_state_dict(shard_file, tp_actions, expected_keys, device="cpu")
-            else:
-                state_dict = load_state_dict(shard_file, None, expected_keys, device="cpu")
-            returned_state_dict.update(state_dict)
-            del state_dict
-            gc.collect()
-
-        return returned_state_dict
-
-    # get tp params
-    state_dict_optim = load_resolved_archive_file(resolved_archive_file, sharded_metadata, expected_keys_optim)
-
-    # need to split param for different sharding rank, maybe need to deal with oom issue.
-    for key in list(state_dict_optim.keys()):
-        key_name = key.split("/")
-        static_name = struct2static_name_mappings.get(key_name[0], None)
-
-        if state_dict_optim[key].numel().item() > 1:
-            begin, end = param_slice_info[static_name]
-            shape, numel, index, padded_size = param_shape_info[static_name]
-            state_dict_optim[key] = state_dict_optim[key].reshape([-1])
-            state_dict_optim[key] = state_dict_optim[key][begin - index : end - index]
-
-            padding_start = max(begin, index + numel)
-            padding_end = min(end, index + padded_size)
-            if padding_start < padding_end:
-                state_dict_optim[key] = paddle.concat(
-                    (
-                        state_dict_optim[key],
-                        paddle.zeros([padding_end - padding_start], dtype=state_dict_optim[key].dtype),
-                    )
+        def to_cpu_tensors(state_dict):
+            with device_guard():
+                for key in list(state_dict.keys()):
+                    state_dict[key] = paddle.Tensor(state_dict.pop(key), zero_copy=True)
+            return state_dict
+
+        # Prefetch one shard ahead, so file reading and tp splitting overlap with the processing
+        # of the previous shard, while at most two shards are kept in host memory.
+        # Only the numpy arrays are read in background, the paddle tensors are created in the main
+        # thread, since device_guard switches the global device.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = None
+            for shard_file in resolved_archive_file:
+                shard_keys = sharded_metadata["file_map"][os.path.split(shard_file)[-1]]
+                if expected_keys.isdisjoint(shard_keys):
+                    continue
+                next_future = executor.submit(
+                    _load_part_state_dict, list(shard_keys), shard_file, tp_actions, expected_keys, "cpu"
                 )
-        if has_master_weights:
-            key_name = "_".join([static_name, FP32_MASTER, key_name[1]])
-        else:
-            key_name = "_".join([static_name, key_name[1]])
+                if future is not None:
+                    yield to_cpu_tensors(future.result())
+                future = next_future
+            if future is not None:
+                yield to_cpu_tensors(future.result())
 
-        state_dict_optim[key] = state_dict_optim[key]._copy_to(paddle.framework._current_expected_place(), False)
+    # get tp params
+    for state_dict_optim in load_resolved_archive_file(resolved_archive_file, sharded_metadata, expected_keys_optim):
+        # need to split param for different sharding rank, maybe need to deal with oom issue.
+        key_names = reshape_params(state_dict_optim, struct2static_name_mappings, param_shape_info, param_slice_info)
+        fused_copy_to_device(state_dict_optim, place)
+        for key in list(state_dict_optim.keys()):
+            _, typename, static_name = key_names[key]
+            if has_master_weights:
+                key_name = "_".join([static_name, FP32_MASTER, typename])
+            else:
+                key_name = "_".join([static_name, typename])
 
-        returned_optim_state_dict[key_name] = state_dict_optim.pop(key)
-        returned_optim_state_dict[key_name].name = key_name
+            rename_and_store(returned_optim_state_dict, key_name, state_dict_optim.pop(key))
 
     if has_master_weights:
-        state_dict_master_weight = load_resolved_archive_file(
+        for state_dict_master_weight in load_resolved_archive_file(
             resolved_archive_file_mw,
             sharded_metadata_mw,
             expected_keys,
             is_master_weights=True,
-        )
-
-        for key in list(state_dict_master_weight.keys()):
-            static_name = struct2static_name_mappings.get(key, None)
-            if state_dict_master_weight[key].numel().item() > 1:
-                begin, end = param_slice_info[static_name]
-                shape, numel, index, padded_size = param_shape_info[static_name]
-                state_dict_master_weight[key] = state_dict_master_weight[key].reshape([-1])
-                state_dict_master_weight[key] = state_dict_master_weight[key][begin - index : end - index]
-
-                padding_start = max(begin, index + numel)
-                padding_end = min(end, index + padded_size)
-                if padding_start < padding_end:
-                    state_dict_master_weight[key] = paddle.concat(
-                        (
-                            state_dict_master_weight[key],
-                            paddle.zeros([padding_end - padding_start], dtype=state_dict_master_weight[key].dtype),
-                        )
-                    )
-            state_dict_master_weight[key] = state_dict_master_weight[key]._copy_to(
-                paddle.framework._current_expected_place(), False
+        ):
+            key_names = reshape_params(
+                state_dict_master_weight,
+                struct2static_name_mappings,
+                param_shape_info,
+                param_slice_info,
+                is_master_weights=True,
             )
-            returned_optim_state_dict["master_weights"][static_name] = state_dict_master_weight.pop(key)
-            returned_optim_state_dict["master_weights"][static_name].name = "_".join([static_name, FP32_MASTER])
+            # master weights are always fp32 in the optimizer
+            fused_copy_to_device(state_dict_master_weight, place, dtype=paddle.float32)
+            for key in list(state_dict_master_weight.keys()):
+                static_name = key_names[key][2]
+                rename_and_store(
+                    returned_optim_state_dict["master_weights"],
+                    static_name,
+                    state_dict_master_weight.pop(key),
+                    name="_".join([static_name, FP32_MASTER]),
+                )
 
+    gc.collect()
     return returned_optim_state_dict
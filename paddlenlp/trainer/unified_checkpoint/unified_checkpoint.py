@@ -80,6 +80,7 @@ from .utils import (
     merge_tensor_parallel_for_optimizer,
     merge_tensor_parallel_with_shard,
     reduce_master_weights_status,
+    rename_and_store,
     rename_shard_file,
     save_model_config,
 )
@@ -287,15 +288,18 @@ class UnifiedCheckpointHandler:
                     key_name = "_".join([static_name, key_name[1]])
             else:
                 key_name = "_".join([static_name, key_name[1]])
-            returned_optim_state_dict[key_name] = optimizer_state_dict.pop(key)
-            returned_optim_state_dict[key_name].name = key_name
+            rename_and_store(returned_optim_state_dict, key_name, optimizer_state_dict.pop(key))
 
         if has_master_weights:
             returned_optim_state_dict["master_weights"] = {}
             for key in list(master_weights.keys()):
                 static_name = struct2static_name_mappings[key]
-                returned_optim_state_dict["master_weights"][static_name] = master_weights.pop(key)
-                returned_optim_state_dict["master_weights"][static_name].name = "_".join([static_name, FP32_MASTER])
+                rename_and_store(
+                    returned_optim_state_dict["master_weights"],
+                    static_name,
+                    master_weights.pop(key),
+                    name="_".join([static_name, FP32_MASTER]),
+                )
 
         return returned_optim_state_dict
 
@@ -315,6 +315,14 @@ def generate_base_static_name(vname):
                 return a, b
 
 
+def rename_and_store(state_dict, key, tensor, name=None):
+    """
+    Set the tensor name (defaults to `key`) before storing it, so that the tensor is looked up and renamed only once.
+    """
+    tensor.name = key if name is None else name
+    state_dict[key] = tensor
+
+
 def merge_large_tensor_parallel(tensor, tp_group, tp_action, dst_rank, is_dst):
     """
     Move large tensor merge process to CPU, in order to avoid OOM.
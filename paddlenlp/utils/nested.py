@@ -99,6 +99,10 @@ def nested_broadcast_tensor_with_empty(tensor, src=0, group=None):
 
 
 def nested_copy(inputs):
+    """
+    Copy the nested dict containers only, the leaf tensors are shared with `inputs` and not cloned.
+    Callers may replace the entries of the returned dict, but must not modify the tensors inplace.
+    """
     if isinstance(inputs, dict):
         outputs = {}
         for key in list(inputs.keys()):
@@ -0,0 +1,246 @@
+# Copyright (c) 2024 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import numpy as np
+import paddle
+
+from paddlenlp.trainer.unified_checkpoint.sharding_split_param_utils import (
+    build_send_recv_table,
+    plan_merge_splited_param,
+    reshape_params,
+)
+
+
+def build_sharding_layout(numels, padded_sizes, sharding_degree):
+    """
+    Lay out the params one after another in a comm buffer, and split the buffer evenly over the sharding ranks.
+    Return param_shape_info and the per-rank param_slice_info, like `get_params_info` on each rank.
+    """
+    total_size = sum(padded_sizes)
+    assert total_size % sharding_degree == 0
+    rank_size = total_size // sharding_degree
+
+    param_shape_info = {}
+    param_slice_info_list = [{} for _ in range(sharding_degree)]
+    index = 0
+    for i, (numel, padded_size) in enumerate(zip(numels, padded_sizes)):
+        name = f"linear_{i}.w_0"
+        param_shape_info[name] = ([numel], numel, index, padded_size, padded_size > numel)
+        for rank in range(sharding_degree):
+            begin = max(index, rank * rank_size)
+            end = min(index + padded_size, (rank + 1) * rank_size)
+            param_slice_info_list[rank][name] = (begin, end) if end > begin else (0, 0)
+        index += padded_size
+    return param_shape_info, param_slice_info_list
+
+
+def reference_send_recv_table(partial_tensor_list, param_slice_info_list, global_ranks):
+    """The nested-loop build of send_table/recv_table, for checking the optimized one."""
+    send_table = {}
+    recv_table = {}
+    for key in partial_tensor_list:
+        sharding_ranklist = []
+        for global_rank, slice_info in zip(global_ranks, param_slice_info_list):
+            begin, end = slice_info[key]
+            if end > begin:
+                sharding_ranklist.append((global_rank, begin, end))
+        recv_table[key] = sharding_ranklist[0][0]
+        send_table[key] = sharding_ranklist
+    return send_table, recv_table
+
+
+def get_partial_tensor_list(param_slice_info, param_shape_info):
+    """Same as the partial tensor scan in `gather_splited_param_for_optimizer`."""
+    partial_tensor_list = []
+    for name, (begin, end) in param_slice_info.items():
+        numel = param_shape_info[name][1]
+        if end > begin and end - begin != numel:
+            partial_tensor_list.append(name)
+    return partial_tensor_list
+
+
+class PlanMergeSplitedParamTest(unittest.TestCase):
+    # global ranks of the sharding group, not contiguous as with other parallelism enabled
+    global_ranks = [0, 2, 4, 6]
+    # params are padded to a multiple of 4, and several of them are splited over rank boundaries
+    numels = [10, 23, 7, 30, 5, 20]
+    padded_sizes = [12, 24, 8, 32, 8, 20]
+
+    def plan_all_ranks(self):
+        param_shape_info, param_slice_info_list = build_sharding_layout(
+            self.numels, self.padded_sizes, len(self.global_ranks)
+        )
+        plans = {}
+        for rank, global_rank in enumerate(self.global_ranks):
+            param_slice_info = param_slice_info_list[rank]
+            partial_tensor_list = get_partial_tensor_list(param_slice_info, param_shape_info)
+            send_table, recv_table = reference_send_recv_table(
+                partial_tensor_list, param_slice_info_list, self.global_ranks
+            )
+            # the states exist only for the local params, in the same order on every rank
+            key_infos = []
+            for name, (begin, end) in param_slice_info.items():
+                if end > begin:
+                    key_infos.append((f"{name}_moment1_0", name, "float32"))
+                    key_infos.append((f"{name}_moment2_0", name, "float32"))
+                    key_infos.append((f"{name}_velocity_0", name, "bfloat16"))
+            plans[global_rank] = plan_merge_splited_param(
+                key_infos, partial_tensor_list, param_shape_info, send_table, recv_table, global_rank
+            )
+        return param_shape_info, plans
+
+    def test_send_recv_buckets_pair_up(self):
+        _, plans = self.plan_all_ranks()
+        num_buckets = 0
+        max_pieces = 0
+        for src in self.global_ranks:
+            for dst in self.global_ranks:
+                if src == dst:
+                    continue
+                send_buckets = plans[src][1]
+                recv_buckets = plans[dst][2]
+                # buffers between the same pair are issued in the same order, with the same pieces
+                send_order = [dtype for peer, dtype in send_buckets.keys() if peer == dst]
+                recv_order = [dtype for peer, dtype in recv_buckets.keys() if peer == src]
+                self.assertEqual(send_order, recv_order)
+                for dtype in send_order:
+                    sent = send_buckets[(dst, dtype)]
+                    received = [(key, length) for key, _, length in recv_buckets[(src, dtype)]]
+                    self.assertEqual(sent, received)
+                    num_buckets += 1
+                    max_pieces = max(max_pieces, len(sent))
+        # make sure the layout really has params splited over ranks, and packs several pieces into one buffer
+        self.assertGreater(num_buckets, 0)
+        self.assertGreater(max_pieces, 1)
+
+    def test_merged_pieces_cover_param(self):
+        param_shape_info, plans = self.plan_all_ranks()
+        for global_rank, (_, _, recv_buckets, merge_list) in plans.items():
+            for key, (shape, num_slots, local_slot, local_length) in merge_list.items():
+                static_name = key.rsplit("_", 2)[0]
+                lengths = {local_slot: local_length}
+                for pieces in recv_buckets.values():
+                    for piece_key, slot, length in pieces:
+                        if piece_key == key:
+                            lengths[slot] = length
+                self.assertEqual(sorted(lengths.keys()), list(range(num_slots)))
+                # the padding is dropped, the merged pieces are exactly the param
+                self.assertEqual(sum(lengths.values()), param_shape_info[static_name][1])
+                self.assertEqual(shape, param_shape_info[static_name][0])
+
+
+class BuildSendRecvTableTest(unittest.TestCase):
+    def check_table(self, global_ranks, param_slice_info_list, partial_tensor_list):
+        # pack the slice info as it is exchanged by all_gather in `gather_splited_param_for_optimizer`
+        param_keys = sorted(param_slice_info_list[0].keys())
+        gathered_slice_info = np.array(
+            [
+                [global_rank] + [pos for key in param_keys for pos in slice_info[key]]
+                for global_rank, slice_info in zip(global_ranks, param_slice_info_list)
+            ],
+            dtype=np.int64,
+        )
+        send_table, recv_table = build_send_recv_table(partial_tensor_list, param_keys, gathered_slice_info)
+        expected_send_table, expected_recv_table = reference_send_recv_table(
+            partial_tensor_list, param_slice_info_list, global_ranks
+        )
+        self.assertEqual(send_table, expected_send_table)
+        self.assertEqual(recv_table, expected_recv_table)
+
+    def test_sharding_layout(self):
+        global_ranks = [1, 3, 5, 7]
+        param_shape_info, param_slice_info_list = build_sharding_layout(
+            [10, 23, 7, 30, 5, 20], [12, 24, 8, 32, 8, 20], len(global_ranks)
+        )
+        partial_tensor_list = []
+        for param_slice_info in param_slice_info_list:
+            partial_tensor_list.extend(get_partial_tensor_list(param_slice_info, param_shape_info))
+        self.check_table(global_ranks, param_slice_info_list, partial_tensor_list)
+
+    def test_random_slices(self):
+        rng = np.random.RandomState(2024)
+        global_ranks = [0, 8, 16, 24, 32, 40, 48, 56]
+        num_params = 50
+        param_slice_info_list = []
+        for _ in global_ranks:
+            slice_info = {}
+            for i in range(num_params):
+                begin, end = sorted(rng.randint(0, 100, size=2).tolist())
+                slice_info[f"param_{i}"] = (begin, end)
+            param_slice_info_list.append(slice_info)
+        partial_tensor_list = [
+            f"param_{i}"
+            for i in range(num_params)
+            if any(slice_info[f"param_{i}"][1] > slice_info[f"param_{i}"][0] for slice_info in param_slice_info_list)
+        ]
+        self.check_table(global_ranks, param_slice_info_list, partial_tensor_list)
+
+
+class ReshapeParamsTest(unittest.TestCase):
+    def setUp(self):
+        # one 2x3 param of 6 elements, padded to 8 in the comm buffer, starting at index 8
+        self.struct2static_name_mappings = {"linear.weight": "linear_0.w_0"}
+        self.param_shape_info = {"linear_0.w_0": ([2, 3], 6, 8, 8, True)}
+        self.param_value = np.arange(6, dtype="float32").reshape([2, 3])
+
+    def reshape(self, begin, end, is_master_weights=False):
+        key = "linear.weight" if is_master_weights else "linear.weight/moment1_0"
+        state_dict = {key: paddle.to_tensor(self.param_value, place=paddle.CPUPlace())}
+        if not is_master_weights:
+            state_dict["linear.weight/beta1_pow_acc_0"] = paddle.to_tensor([0.9], place=paddle.CPUPlace())
+        key_names = reshape_params(
+            state_dict,
+            self.struct2static_name_mappings,
+            self.param_shape_info,
+            {"linear_0.w_0": (begin, end)},
+            is_master_weights=is_master_weights,
+        )
+        return state_dict, key_names
+
+    def test_no_padding(self):
+        self.param_shape_info = {"linear_0.w_0": ([2, 3], 6, 8, 6, False)}
+        state_dict, _ = self.reshape(9, 13)
+        np.testing.assert_array_equal(state_dict["linear.weight/moment1_0"].numpy(), [1, 2, 3, 4])
+
+    def test_tail_padding(self):
+        state_dict, _ = self.reshape(12, 16)
+        tensor = state_dict["linear.weight/moment1_0"]
+        self.assertTrue(tensor.place.is_cpu_place())
+        np.testing.assert_array_equal(tensor.numpy(), [4, 5, 0, 0])
+
+    def test_all_padding(self):
+        state_dict, _ = self.reshape(14, 16)
+        tensor = state_dict["linear.weight/moment1_0"]
+        self.assertTrue(tensor.place.is_cpu_place())
+        np.testing.assert_array_equal(tensor.numpy(), [0, 0])
+
+    def test_key_names(self):
+        state_dict, key_names = self.reshape(8, 16)
+        np.testing.assert_array_equal(state_dict["linear.weight/moment1_0"].numpy(), [0, 1, 2, 3, 4, 5, 0, 0])
+        # the scalar states are kept as they are, but their names are resolved too
+        np.testing.assert_allclose(state_dict["linear.weight/beta1_pow_acc_0"].numpy(), [0.9])
+        self.assertEqual(
+            key_names,
+            {
+                "linear.weight/moment1_0": ("linear.weight", "moment1_0", "linear_0.w_0"),
+                "linear.weight/beta1_pow_acc_0": ("linear.weight", "beta1_pow_acc_0", "linear_0.w_0"),
+            },
+        )
+
+    def test_master_weights(self):
+        state_dict, key_names = self.reshape(10, 14, is_master_weights=True)
+        np.testing.assert_array_equal(state_dict["linear.weight"].numpy(), [2, 3, 4, 5])
+        self.assertEqual(key_names, {"linear.weight": ("linear.weight", None, "linear_0.w_0")})